@@ -486,7 +486,7 @@ def transmitir_nfe(engine, origem: str) -> None:
         st.error(f"Falha na transmissão ({origem}): {mensagem}")
         if resultado.get("erro_completo"):
             with st.expander("Detalhes do erro"):
-                st.code(resultado["erro_completo"])
+                st.code(str(resultado["erro_completo"]))
         else:
             with st.expander("Detalhes técnicos"):
                 st.write(resultado.get("resultado"))
@@ -813,6 +813,7 @@ with aba_xml:
 
     if st.button("Processar XMLs", type="primary", disabled=not arquivos_xml):
         resultados: list[dict[str, Any]] = []
+        entradas: list[tuple[str, bytes]] = []
         for arquivo in arquivos_xml or []:
             dados = arquivo.read()
             if not dados:
@@ -820,14 +821,18 @@ with aba_xml:
                     {"status": "erro", "arquivo": arquivo.name, "mensagem": "Arquivo vazio ou inválido."}
                 )
                 continue
+            entradas.append((arquivo.name, dados))
+        if entradas:
             try:
                 with Session(engine) as session:
                     with session.begin():
-                        resultado = nfe_business.importar_xml_document(session, dados, filename=arquivo.name)
+                        lote = nfe_business.importar_xml_documents(session, entradas)
+                # so entra nos resultados depois do commit: se a transacao
+                # falhar, nada do lote foi gravado e os "ok" seriam mentira
+                resultados.extend(lote)
             except Exception as exc:
-                resultados.append({"status": "erro", "arquivo": arquivo.name, "mensagem": str(exc)})
-            else:
-                resultados.append(resultado)
+                for nome, _ in entradas:
+                    resultados.append({"status": "erro", "arquivo": nome, "mensagem": str(exc)})
 
         for info in resultados:
             status = info.get("status")
@@ -1048,4 +1053,4 @@ with aba_cancelar:
                 st.error(f"Falha ao cancelar: {resultado.get('erro')}")
                 if resultado.get("erro_completo"):
                     with st.expander("Detalhes"):
-                        st.code(resultado["erro_completo"])
+                        st.code(str(resultado["erro_completo"]))
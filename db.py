@@ -1,16 +1,21 @@
 # db.py
 from __future__ import annotations
-import re, unicodedata
-from typing import Iterable, Optional, Tuple, List
+import hashlib, re, unicodedata
+from typing import Optional, Tuple, List
 
 from sqlalchemy import (
-    create_engine, text, String, Boolean, Integer, Text,
+    create_engine, event, text, String, Boolean, Integer, Text,
     UniqueConstraint, Index, ForeignKey, Numeric
 )
 from sqlalchemy.orm import (
     DeclarativeBase, Mapped, mapped_column, relationship, Session
 )
 
+try:
+    from rapidfuzz import fuzz, process
+except Exception:  # pragma: no cover
+    fuzz = process = None
+
 # -------- Base ORM --------
 class Base(DeclarativeBase):
     pass
@@ -33,7 +38,8 @@ class Product(Base):
     )
 
     __table_args__ = (
-        Index("ix_products_name_norm", "name_norm"),
+        # parcial: best_suggestion so consulta produtos ativos
+        Index("ix_products_name_norm_active", "name_norm", postgresql_where=text("active")),
     )
 
 class ProductAlias(Base):
@@ -48,8 +54,8 @@ class ProductAlias(Base):
     product: Mapped[Product] = relationship(back_populates="aliases")
 
     __table_args__ = (
+        # o indice unico composto ja cobre o lookup store_id + alias_norm
         UniqueConstraint("store_id", "alias_norm", name="uq_alias_per_store"),
-        Index("ix_alias_norm", "alias_norm"),
     )
 
 class ProductInbox(Base):
@@ -106,7 +112,16 @@ class NfeXml(Base):
 # -------- Engine / init --------
 def make_engine(database_url: str):
     # psycopg2-binary aceita ?sslmode=require; deixe como veio do Neon
-    return create_engine(database_url, pool_pre_ping=True, future=True)
+    # pool_recycle limita conexoes velhas sem o SELECT 1 extra que o
+    # pre_ping custava a cada checkout (um round-trip por transacao).
+    # executemany_mode liga o fast path do psycopg2 para executemany.
+    return create_engine(
+        database_url,
+        pool_pre_ping=False,
+        pool_recycle=300,
+        executemany_mode="values_plus_batch",
+        future=True,
+    )
 
 def init_db(engine) -> None:
     """
@@ -123,6 +138,30 @@ def init_db(engine) -> None:
             conn.execute(text("ALTER TABLE nfe_xmls ADD COLUMN IF NOT EXISTS cancelada BOOLEAN NOT NULL DEFAULT FALSE"))
         except Exception:
             pass
+        # uq_alias_per_store ja atende o lookup (store_id, alias_norm); o indice
+        # extra em alias_norm so custava escrita em ensure_alias.
+        try:
+            conn.execute(text("DROP INDEX IF EXISTS ix_alias_norm"))
+        except Exception:
+            pass
+        # troca o indice cheio de name_norm por um parcial (somente ativos)
+        try:
+            conn.execute(text("DROP INDEX IF EXISTS ix_products_name_norm"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_products_name_norm_active "
+                "ON products (name_norm) WHERE active"
+            ))
+        except Exception:
+            pass
+
+# -------- Hash de XML (dedup) --------
+def xml_hash(xml_bytes: bytes) -> str:
+    """
+    SHA-256 dos bytes crus do XML (chave de dedup em nfe_xmls.hash).
+    Hasheia os bytes antes de qualquer decode; o OpenSSL do CPython ja
+    despacha para o caminho SHA-NI quando a CPU suporta.
+    """
+    return hashlib.sha256(memoryview(xml_bytes)).digest().hex()
 
 # -------- Normalização de nome --------
 ABBREV = {
@@ -133,14 +172,24 @@ ABBREV = {
     r"\bEMB\.?\b": "EMBALADA",
 }
 
+# mapeia pontuacao ASCII para espaco; o pipeline acima ja garantiu que
+# so restam caracteres < 128 quando a tabela e aplicada.
+_PUNCT_TABLE = {c: 0x20 for c in range(128) if not (chr(c).isalnum() or chr(c).isspace())}
+
 def normalize_name(name: str) -> str:
-    s = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
-    s = s.upper()
+    # atalho: a maioria dos nomes vindos de XML ja e ASCII puro,
+    # entao o NFKD + encode/decode pode ser pulado.
+    if name.isascii():
+        s = name.upper()
+    else:
+        s = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+        s = s.upper()
     for pat, repl in ABBREV.items():
         s = re.sub(pat, repl, s)
-    s = re.sub(r"[^A-Z0-9\s]", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
+    # translate + split/join fazem o papel dos dois re.sub finais em uma
+    # passada C cada (pontuacao -> espaco, colapsa espacos e faz strip).
+    s = s.translate(_PUNCT_TABLE)
+    return " ".join(s.split())
 
 # -------- Operações principais --------
 def upsert_product_by_code(
@@ -170,42 +219,98 @@ def upsert_product_by_code(
         s.flush()
         prod_id = p["id"]
     else:
-        s.execute(text("""
+        prod_id = s.execute(text("""
             INSERT INTO products (code, name, name_norm, ncm, unit, cst_icms, active)
             VALUES (:code, :name, :name_norm, :ncm, :unit, :cst, TRUE)
-        """), {"code": code, "name": name, "name_norm": name_norm, "ncm": ncm, "unit": unit, "cst": cst_icms})
-        s.flush()
-        prod_id = s.execute(text("SELECT id FROM products WHERE code=:code"), {"code": code}).scalar_one()
+            RETURNING id
+        """), {"code": code, "name": name, "name_norm": name_norm, "ncm": ncm, "unit": unit, "cst": cst_icms}).scalar_one()
 
     return s.get(Product, prod_id)
 
+# -------- Cache de aliases em memoria --------
+# (store_id, alias_norm) -> product_id; evita um round-trip por linha no
+# caminho "matched_by_alias" do import. Tabela pequena, cabe em memoria.
+# Escritas feitas dentro de uma transacao aberta ficam pendentes em
+# session.info e so entram no cache global no after_commit; qualquer
+# rollback (inclusive de savepoint) descarta as pendencias, entao o
+# cache nunca guarda ids de linhas que nao chegaram a ser gravadas.
+_alias_cache: dict[Tuple[str, str], int] = {}
+_alias_cache_loaded = False
+_ALIAS_PENDING = "alias_cache_pendentes"
+
+def _alias_cache_defer(s: Session, chave: Tuple[str, str], product_id: int) -> None:
+    s.info.setdefault(_ALIAS_PENDING, {})[chave] = product_id
+
+def _alias_cache_get(s: Session, chave: Tuple[str, str]) -> Optional[int]:
+    pid = _alias_cache.get(chave)
+    if pid:
+        return pid
+    return s.info.get(_ALIAS_PENDING, {}).get(chave)
+
+@event.listens_for(Session, "after_commit")
+def _alias_cache_publish(session: Session) -> None:
+    pendentes = session.info.pop(_ALIAS_PENDING, None)
+    if pendentes:
+        _alias_cache.update(pendentes)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _alias_cache_discard(session: Session, previous_transaction) -> None:
+    # descarta tudo que ainda nao foi publicado; num rollback de savepoint
+    # isso joga fora tambem entradas de arquivos anteriores do lote, que
+    # voltam pelo caminho SQL na proxima consulta — perda de aquecimento,
+    # nunca de correcao
+    session.info.pop(_ALIAS_PENDING, None)
+
+def _load_alias_cache(s: Session) -> None:
+    global _alias_cache_loaded
+    if _alias_cache_loaded:
+        return
+    rows = s.execute(text("SELECT store_id, alias_norm, product_id FROM product_aliases")).all()
+    for store_id, alias_norm, product_id in rows:
+        _alias_cache.setdefault((store_id, alias_norm), product_id)
+    _alias_cache_loaded = True
+
 def ensure_alias(s: Session, *, product_id: int, store_id: str, alias: str) -> None:
     alias_norm = normalize_name(alias)
-    s.execute(text("""
+    inserted = s.execute(text("""
         INSERT INTO product_aliases (product_id, store_id, alias, alias_norm)
         VALUES (:pid, :store, :alias, :alias_norm)
         ON CONFLICT (store_id, alias_norm) DO NOTHING
-    """), {"pid": product_id, "store": store_id, "alias": alias, "alias_norm": alias_norm})
+        RETURNING 1
+    """), {"pid": product_id, "store": store_id, "alias": alias, "alias_norm": alias_norm}).first()
+    # so alimenta o cache quando o INSERT entrou de fato: num conflito o
+    # alias existente pode apontar para outro produto, e cachear o novo
+    # id contradiria o banco ate o restart do processo
+    if inserted:
+        _alias_cache_defer(s, (store_id, alias_norm), product_id)
 
 # -------- Sugestão (fuzzy) sem gravar automático --------
+# lembra se o catalogo tem produtos ativos, para nao consultar de novo
+# a cada linha durante um import em catalogo vazio (bootstrap).
+_catalog_has_products: Optional[bool] = None
+
 def best_suggestion(s: Session, name: str, min_score: int = 85) -> Tuple[Optional[int], float]:
     """
     Retorna (product_id_sugerido, score) usando fuzzy token_sort_ratio (RapidFuzz).
     Não grava nada; apenas sugere.
     """
-    try:
-        from rapidfuzz import process, fuzz
-    except Exception:
+    global _catalog_has_products
+    if process is None or min_score > 100 or _catalog_has_products is False:
         return None, 0.0
 
     name_norm = normalize_name(name)
     rows = s.execute(text("SELECT id, name_norm FROM products WHERE active")).all()
+    _catalog_has_products = bool(rows)
     if not rows:
         return None, 0.0
 
     ids = [r[0] for r in rows]
     names = [r[1] for r in rows]
-    match, score, idx = process.extractOne(name_norm, names, scorer=fuzz.token_sort_ratio)
+    # processor=None: os nomes ja passaram por normalize_name, entao o
+    # default_process do RapidFuzz so repetiria trabalho por candidato.
+    match, score, idx = process.extractOne(
+        name_norm, names, scorer=fuzz.token_sort_ratio, processor=None
+    )
     if score >= min_score:
         return ids[idx], float(score)
     return None, float(score)
@@ -277,28 +382,41 @@ def import_row(
     2) Sem code -> tenta achar alias exato (normalize) dessa loja.
     3) Não achou -> calcula sugestão fuzzy e manda para inbox (com score).
     """
+    global _catalog_has_products
     name_norm = normalize_name(name)
+    # carga antes de qualquer INSERT de alias desta transacao: o snapshot
+    # so pode conter linhas ja commitadas
+    _load_alias_cache(s)
 
     if code:
         prod = upsert_product_by_code(s, code=code, name=name, ncm=ncm, unit=unit, cst_icms=cst_icms)
+        _catalog_has_products = True
         ensure_alias(s, product_id=prod.id, store_id=store_id, alias=name)
         return {"status": "upsert_by_code", "product_id": prod.id}
 
-    # tenta alias exato (normalize) por loja
-    pid = s.execute(text("""
-        SELECT p.id
-          FROM product_aliases a
-          JOIN products p ON p.id = a.product_id
-         WHERE a.store_id=:store AND a.alias_norm=:an
-         LIMIT 1
-    """), {"store": store_id, "an": name_norm}).scalar()
+    # tenta alias exato (normalize) por loja — cache, pendencias da
+    # transacao atual e por fim SQL
+    pid = _alias_cache_get(s, (store_id, name_norm))
+    if not pid:
+        pid = s.execute(text("""
+            SELECT p.id
+              FROM product_aliases a
+              JOIN products p ON p.id = a.product_id
+             WHERE a.store_id=:store AND a.alias_norm=:an
+             LIMIT 1
+        """), {"store": store_id, "an": name_norm}).scalar()
+        if pid:
+            _alias_cache_defer(s, (store_id, name_norm), pid)
 
     if pid:
         ensure_alias(s, product_id=pid, store_id=store_id, alias=name)
         return {"status": "matched_by_alias", "product_id": pid}
 
-    # sugestão fuzzy (não grava)
-    spid, score = best_suggestion(s, name, min_score=min_fuzzy_score)
+    # sugestão fuzzy (não grava); score >= 100 equivale a fuzzy desligado
+    if min_fuzzy_score >= 100:
+        spid, score = None, 0.0
+    else:
+        spid, score = best_suggestion(s, name, min_score=min_fuzzy_score)
     enqueue_inbox(
         s, store_id=store_id, raw_name=name, raw_code=code, raw_ncm=ncm,
         raw_unit=unit, reason="no_match", suggested_product_id=spid, score=score or None
@@ -1,40 +1,130 @@
 from __future__ import annotations
 
-import hashlib
+import functools
+import json
+import os
 import re
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from io import BytesIO
 from decimal import Decimal, InvalidOperation
 from typing import Any
 
+import numpy as np
+import orjson
 import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from lxml import etree
-from sqlalchemy import select
+from sqlalchemy import bindparam, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
+try:
+    import redis
+except ImportError:  # cache compartilhado e opcional
+    redis = None
+
 import db
 from pynfe.entidades import Emitente, Cliente, NotaFiscal, _fonte_dados
 from pynfe.entidades.evento import EventoCancelarNota
 from pynfe.processamento.serializacao import SerializacaoXML
 from pynfe.processamento.assinatura import AssinaturaA1
 
+class _LazyTb:
+    """
+    Traceback preguicoso para os dicts de erro: formatar a pilha so custa
+    quando a mensagem e de fato exibida (st.code), nao a cada falha num lote.
+    """
+
+    __slots__ = ("prefixo", "exc")
+
+    def __init__(self, prefixo: str, exc: BaseException):
+        self.prefixo = prefixo
+        self.exc = exc
+
+    def __str__(self) -> str:
+        detalhes = "".join(
+            traceback.format_exception(type(self.exc), self.exc, self.exc.__traceback__)
+        )
+        return f"{self.prefixo}\n{detalhes}"
+
+
+# grava uma copia do XML assinado em disco para depuracao (NFE_DUMP_XML=1)
+_DUMP_XML = os.getenv("NFE_DUMP_XML") == "1"
+
 CODIGO_BRASIL = "1058"
 NFE_NS = {"nfe": "http://www.portalfiscal.inf.br/nfe"}
+
+# mapas formulario -> codigo NFe (constantes, nao reconstruir por nota)
+_TIPO_DOCUMENTO_MAP = {"Saída": 1, "Entrada": 0}
+_FINALIDADE_MAP = {"Normal": "1", "Complementar": "2", "Ajuste": "3", "Devolução": "4"}
+_CLIENTE_FINAL_MAP = {"Sim": 1, "Não": 0}
+_PRESENCA_MAP = {"Presencial": 1, "Internet": 2, "Teleatendimento": 3, "Não se aplica": 9}
+_FORMA_PAGAMENTO_MAP = {
+    "Dinheiro": 0,
+    "Cartão de Crédito": 0,
+    "Cartão de Débito": 0,
+    "PIX": 0,
+    "Boleto": 1,
+    "Transferência": 0,
+}
 XML_PARSER = etree.XMLParser(remove_blank_text=True, recover=True)
 
 
-def _text(node, path, default="") -> str:
+@functools.lru_cache(maxsize=None)
+def _xp(path: str) -> etree.XPath:
+    """Compila (uma vez) um XPath com o namespace da NFe ja vinculado."""
+    return etree.XPath(path, namespaces=NFE_NS)
+
+
+def _first(node, path):
     if node is None:
-        return default
-    try:
-        elem = node.find(path, NFE_NS)
-    except etree.XPathEvalError:
-        return default
+        return None
+    result = _xp(path)(node)
+    return result[0] if result else None
+
+
+def _text(node, path, default="") -> str:
+    elem = _first(node, path)
     if elem is None or elem.text is None:
         return default
     return elem.text.strip()
 
 
+def _scatter(elem) -> dict[str, str]:
+    """
+    Espalha os filhos diretos de um elemento num dict {localname: texto}.
+    Uma unica passada substitui um find() por campo; setdefault preserva a
+    semantica de find (primeira ocorrencia vence).
+    """
+    if elem is None:
+        return {}
+    campos: dict[str, str] = {}
+    for child in elem:
+        tag = child.tag
+        if isinstance(tag, str):
+            campos.setdefault(tag.rpartition("}")[2], (child.text or "").strip())
+    return campos
+
+
+def _tributo_aproximado(valor_total) -> str:
+    """
+    15% aproximado com 2 casas, em centavos inteiros: evita o par de
+    construcoes Decimal + round por produto. Retorna ja como string.
+    """
+    cents = int(round(float(valor_total) * 100))
+    # arredondamento half-even, o mesmo do round() de Decimal: meio
+    # centavo exato vai para o par, nao sempre para cima
+    q, r = divmod(cents * 15, 100)
+    tax_cents = q + (r > 50 or (r == 50 and q % 2))
+    return f"{tax_cents // 100}.{tax_cents % 100:02d}"
+
+
 def _safe_decimal(value: str | None) -> Decimal | None:
     if not value:
         return None
@@ -44,6 +134,39 @@ def _safe_decimal(value: str | None) -> Decimal | None:
         return None
 
 
+@functools.lru_cache(maxsize=4)
+def _carregar_assinador(cert_path: str, mtime: float, senha: str):
+    return AssinaturaA1(cert_path, senha)
+
+
+def _assinador(cert_path: str, senha: str):
+    """
+    AssinaturaA1 cacheado por (path, mtime, senha): o parse do PKCS#12 e a
+    derivacao da chave sao pagos uma vez por certificado, nao por nota.
+    O mtime na chave invalida o cache se o arquivo for trocado.
+    """
+    return _carregar_assinador(cert_path, os.path.getmtime(cert_path), senha)
+
+
+# extracao de cStat/xMotivo das respostas da SEFAZ (sem namespace fixo)
+_XP_CSTAT = etree.XPath("//*[local-name()='cStat']/text()")
+_XP_XMOTIVO = etree.XPath("//*[local-name()='xMotivo']/text()")
+_RE_CSTAT = re.compile(r"<cStat>(\d+)</cStat>")
+_RE_XMOTIVO = re.compile(r"<xMotivo>(.*?)</xMotivo>")
+
+
+def _extrair_cstat_xmotivo(response_text: str) -> tuple[list, list]:
+    """
+    Lista de cStat e xMotivo da resposta SEFAZ em uma unica passada lxml;
+    cai para o regex antigo apenas se o corpo nao for XML valido.
+    """
+    try:
+        doc = etree.fromstring(response_text.encode("utf-8"))
+    except etree.XMLSyntaxError:
+        return _RE_CSTAT.findall(response_text), _RE_XMOTIVO.findall(response_text)
+    return list(_XP_CSTAT(doc)), list(_XP_XMOTIVO(doc))
+
+
 def _numero_from_chave(chave: str | None) -> str:
     if not chave or len(chave) != 44:
         return ""
@@ -55,24 +178,230 @@ def _numero_from_chave(chave: str | None) -> str:
 
 
 
-def extrair_dados_cnpj(cnpj: str) -> dict:
+# dados cadastrais mudam raramente; respostas boas ficam 24h em cache
+# (limitado a _CNPJ_CACHE_MAX entradas, descartando as mais antigas)
+_CNPJ_CACHE: dict[str, tuple[float, dict]] = {}
+_CNPJ_CACHE_TTL = 86400.0
+_CNPJ_CACHE_MAX = 4096
+_CNPJ_CACHE_LOCK = threading.Lock()
+
+
+def _cache_local_cnpj(cnpj: str, dados: dict) -> None:
+    """Grava no cache local aplicando o teto; seguro entre threads."""
+    with _CNPJ_CACHE_LOCK:
+        while len(_CNPJ_CACHE) >= _CNPJ_CACHE_MAX:
+            _CNPJ_CACHE.pop(next(iter(_CNPJ_CACHE)), None)
+        _CNPJ_CACHE[cnpj] = (time.monotonic() + _CNPJ_CACHE_TTL, dados)
+
+# cache compartilhado entre processos via Redis (opcional, ativado por
+# REDIS_URL): entradas ficam "frescas" por 24h e ainda servem como
+# fallback "stale" por 7 dias se a API estiver fora do ar
+_CNPJ_CACHE_STALE_TTL = 7 * 86400.0
+_REDIS = (
+    redis.Redis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    if redis is not None and os.getenv("REDIS_URL")
+    else None
+)
+
+
+def _redis_entry(cnpj: str) -> dict | None:
+    """Hash bruto da entrada no Redis (body, janelas e validadores HTTP)."""
+    if _REDIS is None:
+        return None
+    try:
+        entrada = _REDIS.hgetall(f"cnpj:{cnpj}")
+    except redis.RedisError:
+        return None
+    return entrada or None
+
+
+def _entry_body(entrada: dict) -> dict | None:
+    try:
+        return json.loads(entrada["body"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _redis_get_cnpj(cnpj: str, allow_stale: bool = False) -> dict | None:
+    entrada = _redis_entry(cnpj)
+    if not entrada:
+        return None
+    limite = entrada.get("stale_until" if allow_stale else "fresh_until")
+    if not limite or float(limite) <= time.time():
+        return None
+    return _entry_body(entrada)
+
+
+def _redis_set_cnpj(
+    cnpj: str,
+    dados: dict,
+    etag: str | None = None,
+    last_modified: str | None = None,
+) -> None:
+    if _REDIS is None:
+        return
+    agora = time.time()
+    chave = f"cnpj:{cnpj}"
+    mapping = {
+        "body": json.dumps(dados),
+        "fresh_until": agora + _CNPJ_CACHE_TTL,
+        "stale_until": agora + _CNPJ_CACHE_STALE_TTL,
+    }
+    if etag:
+        mapping["etag"] = etag
+    if last_modified:
+        mapping["last_modified"] = last_modified
+    try:
+        _REDIS.hset(chave, mapping=mapping)
+        _REDIS.expire(chave, int(_CNPJ_CACHE_STALE_TTL))
+    except redis.RedisError:
+        pass
+
+
+def _redis_touch_cnpj(cnpj: str) -> None:
+    """Renova as janelas fresh/stale sem reescrever o body (304)."""
+    if _REDIS is None:
+        return
+    agora = time.time()
+    chave = f"cnpj:{cnpj}"
+    try:
+        _REDIS.hset(
+            chave,
+            mapping={
+                "fresh_until": agora + _CNPJ_CACHE_TTL,
+                "stale_until": agora + _CNPJ_CACHE_STALE_TTL,
+            },
+        )
+        _REDIS.expire(chave, int(_CNPJ_CACHE_STALE_TTL))
+    except redis.RedisError:
+        pass
+
+# sessao unica com keep-alive: evita um handshake TCP+TLS por consulta e
+# re-tenta sozinha os erros transitorios tipicos da API publica
+_SESSION = requests.Session()
+_SESSION.headers["Accept"] = "*/*"
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[429, 502, 503, 504],
+        ),
+    ),
+)
+
+
+# single-flight: um unico fetch em voo por CNPJ; chamadas concorrentes
+# do mesmo CNPJ esperam o resultado em vez de duplicar a consulta
+_INFLIGHT: dict[str, Future] = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def extrair_dados_cnpj(cnpj: str, force_refresh: bool = False) -> dict:
     """
     Consulta a API publica.cnpj.ws e retorna os principais dados do CNPJ.
+
+    Consultas repetidas do mesmo CNPJ dentro de 24h saem do cache (local
+    e, se configurado, Redis), sem tocar a rede; consultas concorrentes
+    do mesmo CNPJ compartilham um unico fetch. Se a API falhar, uma
+    entrada "stale" do Redis ainda vale como resposta. Erros nao sao
+    cacheados; force_refresh ignora os caches e reconsulta.
     """
-    response = requests.get(
-        f"https://publica.cnpj.ws/cnpj/{cnpj}",
-        headers={"Accept": "*/*"},
-        timeout=30,
-    )
+    if not force_refresh:
+        hit = _CNPJ_CACHE.get(cnpj)
+        if hit and hit[0] > time.monotonic():
+            return dict(hit[1])
+
+    with _INFLIGHT_LOCK:
+        fut = _INFLIGHT.get(cnpj)
+        dono = fut is None
+        if dono:
+            fut = Future()
+            _INFLIGHT[cnpj] = fut
+
+    if not dono:
+        return dict(fut.result(timeout=60))
+
+    try:
+        resultado = _consultar_cnpj(cnpj, force_refresh)
+        fut.set_result(resultado)
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(cnpj, None)
+    return dict(resultado)
+
+
+def extrair_dados_cnpj_batch(cnpjs: list[str]) -> list[dict]:
+    """
+    Consulta varios CNPJs em paralelo e devolve os resultados na ordem
+    de entrada. O pool fica em 16 threads, abaixo do pool_maxsize da
+    _SESSION, entao as conexoes keep-alive sao reaproveitadas.
+    """
+    if not cnpjs:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(cnpjs), 16)) as pool:
+        return list(pool.map(extrair_dados_cnpj, cnpjs))
+
+
+def _consultar_cnpj(cnpj: str, force_refresh: bool) -> dict:
+    """Caminho de rede da consulta (Redis, GET condicional e parse)."""
+    entrada = None
+    if not force_refresh:
+        entrada = _redis_entry(cnpj)
+        if entrada:
+            limite = entrada.get("fresh_until")
+            if limite and float(limite) > time.time():
+                dados = _entry_body(entrada)
+                if dados is not None:
+                    _cache_local_cnpj(cnpj, dados)
+                    return dict(dados)
+
+    # entrada vencida mas presente: revalida condicionalmente; um 304
+    # custa um RTT sem body nem parse
+    headers = {}
+    if entrada:
+        if entrada.get("etag"):
+            headers["If-None-Match"] = entrada["etag"]
+        if entrada.get("last_modified"):
+            headers["If-Modified-Since"] = entrada["last_modified"]
+
+    try:
+        response = _SESSION.get(
+            f"https://publica.cnpj.ws/cnpj/{cnpj}",
+            headers=headers or None,
+            timeout=30,
+        )
+    except requests.RequestException as e:
+        stale = _redis_get_cnpj(cnpj, allow_stale=True)
+        if stale is not None:
+            return dict(stale)
+        return {"erro": f"Erro na consulta: {e}"}
+
+    if response.status_code == 304 and entrada:
+        dados = _entry_body(entrada)
+        if dados is not None:
+            _redis_touch_cnpj(cnpj)
+            _cache_local_cnpj(cnpj, dados)
+            return dict(dados)
 
     if response.status_code != 200:
+        stale = _redis_get_cnpj(cnpj, allow_stale=True)
+        if stale is not None:
+            return dict(stale)
         return {"erro": f"Erro na consulta: {response.status_code}"}
 
-    data = response.json()
+    # orjson decodifica os bytes direto, sem o decode pra str do .json()
+    data = orjson.loads(response.content)
     est = data["estabelecimento"]
     tel = est["telefone1"] or est["telefone2"]
 
-    return {
+    dados = {
         "cnpj": est["cnpj"],
         "razao_social": data["razao_social"],
         "nome_fantasia": est["nome_fantasia"],
@@ -90,137 +419,282 @@ def extrair_dados_cnpj(cnpj: str) -> dict:
         "cep": est["cep"],
         "telefone": tel,
     }
+    _cache_local_cnpj(cnpj, dados)
+    _redis_set_cnpj(
+        cnpj,
+        dados,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+    return dict(dados)
+
+
+# colunas de Client aceitas no payload e, para as que tem nome alternativo
+# na origem (API de CNPJ / XML), as chaves tentadas em ordem
+_CLIENT_COLS = (
+    "documento",
+    "nome",
+    "nome_fantasia",
+    "logradouro",
+    "numero",
+    "bairro",
+    "inscricao_estadual",
+    "cidade",
+    "uf",
+    "cep",
+    "endereco_complemento",
+    "endereco_pais",
+    "ibge_id",
+    "telefone",
+    "email",
+)
+_CLIENT_ALIASES = {
+    "documento": ("documento", "cnpj"),
+    "nome": ("nome", "razao_social"),
+}
+
+# statements quentes montados uma unica vez: a execucao so troca os
+# parametros, sem reconstruir a arvore do statement a cada chamada
+_CLIENT_UPSERT = pg_insert(db.Client).values(
+    {c: bindparam(c) for c in _CLIENT_COLS}
+)
+_CLIENT_UPSERT = _CLIENT_UPSERT.on_conflict_do_update(
+    index_elements=[db.Client.documento],
+    set_={c: _CLIENT_UPSERT.excluded[c] for c in _CLIENT_COLS if c != "documento"},
+).returning(db.Client)
+
+
+def _client_payload(dados: dict) -> dict:
+    """Monta o dict de colunas de Client a partir dos dados de entrada."""
+    payload = {
+        c: next(
+            (dados[k] for k in _CLIENT_ALIASES.get(c, (c,)) if dados.get(k)),
+            None,
+        )
+        for c in _CLIENT_COLS
+    }
+    if not payload["documento"]:
+        raise ValueError("Documento do cliente nao informado.")
+    return payload
 
 
-def upsert_client(session: Session, dados: dict) -> db.Client:
+# teto de bind params por statement no protocolo estendido do Postgres
+_PG_PARAM_LIMIT = 32767
+
+
+def bulk_upsert_clients(session: Session, payloads: list[dict]) -> list[int]:
     """
-    Insere ou atualiza um cliente com base no documento (CNPJ/CPF).
+    Insere/atualiza varios clientes via INSERT ... ON CONFLICT DO UPDATE
+    multi-linha e devolve os ids na ordem dos payloads. Lotes grandes sao
+    fatiados para caber no limite de parametros do driver.
+
+    Os documentos devem ser distintos entre si: o Postgres rejeita um
+    ON CONFLICT DO UPDATE que atinja a mesma linha duas vezes no mesmo
+    statement. Quem recebe entrada com possiveis repeticoes deduplica
+    antes (ver importar_clientes_por_cnpj).
     """
-    documento = dados.get("documento") or dados.get("cnpj")
-    if not documento:
-        raise ValueError("Documento do cliente nao informado.")
-
-    payload = {
-        "documento": documento,
-        "nome": dados.get("nome") or dados.get("razao_social"),
-        "nome_fantasia": dados.get("nome_fantasia"),
-        "logradouro": dados.get("logradouro"),
-        "numero": dados.get("numero"),
-        "bairro": dados.get("bairro"),
-        "inscricao_estadual": dados.get("inscricao_estadual"),
-        "cidade": dados.get("cidade"),
-        "uf": dados.get("uf"),
-        "cep": dados.get("cep"),
-        "endereco_complemento": dados.get("endereco_complemento"),
-        "endereco_pais": dados.get("endereco_pais"),
-        "ibge_id": dados.get("ibge_id"),
-        "telefone": dados.get("telefone"),
-        "email": dados.get("email"),
-    }
+    if not payloads:
+        return []
+
+    cols = list(payloads[0])
+    passo = min(10_000, _PG_PARAM_LIMIT // len(cols))
+    ids: list[int] = []
+    for inicio in range(0, len(payloads), passo):
+        parte = payloads[inicio : inicio + passo]
+        stmt = pg_insert(db.Client).values(parte)
+        stmt = (
+            stmt.on_conflict_do_update(
+                index_elements=[db.Client.documento],
+                set_={c: stmt.excluded[c] for c in cols if c != "documento"},
+            )
+            .returning(db.Client.id)
+        )
+        ids.extend(session.scalars(stmt))
+    return ids
 
-    stmt = select(db.Client).where(db.Client.documento == documento).with_for_update()
-    client = session.scalars(stmt).first()
 
-    if client:
-        for field, value in payload.items():
-            setattr(client, field, value)
-    else:
-        client = db.Client(**payload)
-        session.add(client)
+def upsert_client(session: Session, dados: dict) -> db.Client:
+    """
+    Insere ou atualiza um cliente com base no documento (CNPJ/CPF).
 
-    session.flush()
-    return client
+    Um unico INSERT ... ON CONFLICT DO UPDATE cobre os dois casos, sem o
+    SELECT ... FOR UPDATE previo (o unique de `documento` resolve a
+    concorrencia no proprio banco) e sem flush: RETURNING ja traz o id.
+    """
+    payload = _client_payload(dados)
+    return session.scalars(
+        _CLIENT_UPSERT, payload, execution_options={"populate_existing": True}
+    ).one()
 
 
 def importar_cliente_por_cnpj(session: Session, cnpj: str) -> dict:
     """
     Consulta o CNPJ na API externa e grava/atualiza o cliente.
+
+    Entradas que nao sejam um CPF/CNPJ (11 ou 14 digitos) caem fora
+    antes de gastar rede ou banco.
     """
+    cnpj = limpar_documento(cnpj)
+    if not _DOC_VALIDO.fullmatch(cnpj):
+        return {"erro": f"CNPJ/CPF invalido: {cnpj or 'vazio'}"}
+
     dados = extrair_dados_cnpj(cnpj)
     if "erro" in dados:
         return dados
 
-    client = upsert_client(session, dados)
-    return {"status": "ok", "client_id": client.id}
+    # so o id interessa aqui: o RETURNING do caminho bulk dispensa a
+    # hidratacao do objeto ORM (quem precisar dele usa upsert_client)
+    ids = bulk_upsert_clients(session, [_client_payload(dados)])
+    return {"status": "ok", "client_id": ids[0]}
 
 
-def parse_nfe_xml(xml_bytes: bytes) -> dict[str, Any]:
+def importar_clientes_por_cnpj(session: Session, cnpjs: list[str]) -> list[dict]:
     """
-    Extrai dados principais (destinatário, produtos, totais) de um XML de NFe.
+    Importa varios CNPJs de uma vez: as consultas HTTP saem concorrentes
+    num pool de threads (limitado pelo pool de conexoes da _SESSION) e os
+    upserts rodam em seguida, todos na mesma transacao da Session.
     """
-    root = etree.fromstring(xml_bytes, parser=XML_PARSER)
-    ide = root.find(".//nfe:ide", NFE_NS)
-    inf_nfe = root.find(".//nfe:infNFe", NFE_NS)
-
-    if root.tag.endswith("procEventoNFe"):
-        desc = root.findtext(".//nfe:detEvento/nfe:descEvento", namespaces=NFE_NS)
-        chave_evento = root.findtext(".//nfe:chNFe", namespaces=NFE_NS) or ""
-        cancelada = bool(desc and "Cancelamento" in desc)
-        return {
-            "numero": _numero_from_chave(chave_evento),
-            "serie": "",
-            "data_emissao": root.findtext(".//nfe:dhEvento", namespaces=NFE_NS),
-            "valor_total": "0",
-            "chave": chave_evento,
-            "destinatario": {"documento": root.findtext(".//nfe:CNPJDest", namespaces=NFE_NS) or ""},
-            "produtos": [],
-            "cancelada": cancelada,
-        }
+    if not cnpjs:
+        return []
+
+    def consulta(cnpj: str) -> dict:
+        doc = limpar_documento(cnpj)
+        if not _DOC_VALIDO.fullmatch(doc):
+            return {"erro": f"CNPJ/CPF invalido: {cnpj or 'vazio'}"}
+        return extrair_dados_cnpj(doc)
+
+    with ThreadPoolExecutor(max_workers=min(len(cnpjs), 16)) as pool:
+        respostas = list(pool.map(consulta, cnpjs))
+
+    # dedup por documento: repetir a mesma linha num ON CONFLICT DO
+    # UPDATE e erro no Postgres; o id volta para todas as posicoes
+    resultados: list[dict] = [{} for _ in cnpjs]
+    payloads: list[dict] = []
+    posicoes: dict[str, list[int]] = {}
+    for i, (cnpj, dados) in enumerate(zip(cnpjs, respostas)):
+        if "erro" in dados:
+            resultados[i] = {"cnpj": cnpj, **dados}
+            continue
+        payload = _client_payload(dados)
+        repetidas = posicoes.get(payload["documento"])
+        if repetidas is not None:
+            repetidas.append(i)
+        else:
+            posicoes[payload["documento"]] = [i]
+            payloads.append(payload)
+
+    for payload, client_id in zip(payloads, bulk_upsert_clients(session, payloads)):
+        for i in posicoes[payload["documento"]]:
+            resultados[i] = {"cnpj": cnpjs[i], "status": "ok", "client_id": client_id}
+    return resultados
+
+
+def _parse_proc_evento(root) -> dict[str, Any]:
+    """Extrai os dados de um procEventoNFe (ex.: evento de cancelamento)."""
+    desc = _text(root, ".//nfe:detEvento/nfe:descEvento")
+    chave_evento = _text(root, ".//nfe:chNFe")
+    return {
+        "numero": _numero_from_chave(chave_evento),
+        "serie": "",
+        "data_emissao": _text(root, ".//nfe:dhEvento") or None,
+        "valor_total": "0",
+        "chave": chave_evento,
+        "destinatario": {"documento": _text(root, ".//nfe:CNPJDest")},
+        "produtos": [],
+        "cancelada": "Cancelamento" in desc,
+    }
+
+
+def _parse_dest(dest) -> dict[str, Any]:
+    campos = _scatter(dest)
+    ender = _scatter(_first(dest, "nfe:enderDest"))
+    return {
+        "documento": campos.get("CNPJ", "") or campos.get("CPF", ""),
+        "nome": campos.get("xNome", ""),
+        "nome_fantasia": campos.get("xFant") or None,
+        "logradouro": ender.get("xLgr", ""),
+        "numero": ender.get("nro", ""),
+        "bairro": ender.get("xBairro", ""),
+        "inscricao_estadual": campos.get("IE", ""),
+        "cidade": ender.get("xMun", ""),
+        "uf": ender.get("UF", ""),
+        "cep": ender.get("CEP", ""),
+        "endereco_complemento": ender.get("xCpl", ""),
+        "endereco_pais": ender.get("xPais", ""),
+        "ibge_id": ender.get("cMun", ""),
+        "telefone": campos.get("fone", ""),
+        "email": campos.get("email", ""),
+    }
+
+
+def _parse_det(det) -> dict[str, Any]:
+    prod = _scatter(_first(det, "nfe:prod"))
+    # ICMS mora em profundidade fixa; caminho direto evita varrer a
+    # subarvore inteira do <det> por produto
+    imposto_icms = _first(det, "nfe:imposto/nfe:ICMS")
+    cst_icms = "40"
+    if imposto_icms is not None:
+        for child in imposto_icms:
+            grupo = _scatter(child)
+            cst_tmp = grupo.get("CST", "") or grupo.get("CSOSN", "")
+            if cst_tmp:
+                cst_icms = cst_tmp
+                break
 
-    cancelada = False
-    numero = _text(ide, "nfe:nNF")
-    serie = _text(ide, "nfe:serie")
-    data_emissao = _text(ide, "nfe:dhEmi") or _text(ide, "nfe:dEmi")
-    valor_total = _text(root, ".//nfe:ICMSTot/nfe:vNF")
-    chave = ""
-    if inf_nfe is not None:
-        chave = (inf_nfe.get("Id") or "").replace("NFe", "")
-
-    dest = root.find(".//nfe:dest", NFE_NS)
-    end_dest = dest.find("nfe:enderDest", NFE_NS) if dest is not None else None
-    destinatario = {
-        "documento": _text(dest, "nfe:CNPJ") or _text(dest, "nfe:CPF"),
-        "nome": _text(dest, "nfe:xNome"),
-        "nome_fantasia": _text(dest, "nfe:xFant") or None,
-        "logradouro": _text(end_dest, "nfe:xLgr"),
-        "numero": _text(end_dest, "nfe:nro"),
-        "bairro": _text(end_dest, "nfe:xBairro"),
-        "inscricao_estadual": _text(dest, "nfe:IE"),
-        "cidade": _text(end_dest, "nfe:xMun"),
-        "uf": _text(end_dest, "nfe:UF"),
-        "cep": _text(end_dest, "nfe:CEP"),
-        "endereco_complemento": _text(end_dest, "nfe:xCpl"),
-        "endereco_pais": _text(end_dest, "nfe:xPais"),
-        "ibge_id": _text(end_dest, "nfe:cMun"),
-        "telefone": _text(dest, "nfe:fone"),
-        "email": _text(dest, "nfe:email"),
+    return {
+        "codigo": prod.get("cProd", ""),
+        "nome": prod.get("xProd", ""),
+        "ncm": prod.get("NCM", ""),
+        "cfop": prod.get("CFOP", ""),
+        "unidade": prod.get("uCom", "") or "UN",
+        "quantidade": prod.get("qCom", ""),
+        "valor_unitario": prod.get("vUnCom", ""),
+        "valor_total": prod.get("vProd", ""),
+        "cst_icms": cst_icms or "40",
     }
 
+
+def parse_nfe_xml(xml_bytes: bytes) -> dict[str, Any]:
+    """
+    Extrai dados principais (destinatário, produtos, totais) de um XML de NFe.
+
+    O documento e percorrido em streaming (iterparse); cada <det> ja
+    consumido e liberado, mantendo a memoria de pico proporcional a um
+    produto, e nao ao documento inteiro.
+    """
+    numero = serie = data_emissao = valor_total = chave = ""
+    destinatario = _parse_dest(None)
     produtos: list[dict[str, Any]] = []
-    for det in root.findall(".//nfe:det", NFE_NS):
-        prod = det.find("nfe:prod", NFE_NS)
-        imposto_icms = det.find(".//nfe:ICMS", NFE_NS)
-        cst_icms = "40"
-        if imposto_icms is not None:
-            for child in list(imposto_icms):
-                cst_tmp = _text(child, "nfe:CST") or _text(child, "nfe:CSOSN")
-                if cst_tmp:
-                    cst_icms = cst_tmp
-                    break
-
-        produtos.append(
-            {
-                "codigo": _text(prod, "nfe:cProd"),
-                "nome": _text(prod, "nfe:xProd"),
-                "ncm": _text(prod, "nfe:NCM"),
-                "cfop": _text(prod, "nfe:CFOP"),
-                "unidade": _text(prod, "nfe:uCom") or "UN",
-                "quantidade": _text(prod, "nfe:qCom"),
-                "valor_unitario": _text(prod, "nfe:vUnCom"),
-                "valor_total": _text(prod, "nfe:vProd"),
-                "cst_icms": cst_icms or "40",
-            }
-        )
+    root = None
+
+    for event, elem in etree.iterparse(BytesIO(xml_bytes), events=("start", "end"), recover=True):
+        if root is None:
+            root = elem
+            if root.tag.endswith("procEventoNFe"):
+                # eventos sao pequenos; parse integral reaproveita o caminho antigo
+                return _parse_proc_evento(etree.fromstring(xml_bytes, parser=XML_PARSER))
+            continue
+        if event != "end":
+            continue
+        tag = elem.tag.rpartition("}")[2] if isinstance(elem.tag, str) else ""
+        if tag == "det":
+            produtos.append(_parse_det(elem))
+            # libera o <det> consumido e os irmaos anteriores ja processados
+            elem.clear(keep_tail=True)
+            parent = elem.getparent()
+            while elem.getprevious() is not None:
+                del parent[0]
+        elif tag == "ide":
+            campos = _scatter(elem)
+            numero = campos.get("nNF", "")
+            serie = campos.get("serie", "")
+            data_emissao = campos.get("dhEmi", "") or campos.get("dEmi", "")
+        elif tag == "dest":
+            destinatario = _parse_dest(elem)
+        elif tag == "ICMSTot":
+            valor_total = _scatter(elem).get("vNF", "")
+        elif tag == "infNFe":
+            chave = (elem.get("Id") or "").replace("NFe", "")
 
     return {
         "numero": numero,
@@ -230,14 +704,12 @@ def parse_nfe_xml(xml_bytes: bytes) -> dict[str, Any]:
         "chave": chave,
         "destinatario": destinatario,
         "produtos": produtos,
-        "cancelada": cancelada,
+        "cancelada": False,
     }
 
 
-def get_emitente_data() -> dict:
-    """
-    Lê os dados do emitente definidos nos secrets ([emitente]).
-    """
+@functools.lru_cache(maxsize=1)
+def _load_emitente() -> dict:
     try:
         emitente = dict(st.secrets["emitente"])
     except Exception as exc:
@@ -250,8 +722,23 @@ def get_emitente_data() -> dict:
     return emitente
 
 
+def get_emitente_data() -> dict:
+    """
+    Lê os dados do emitente definidos nos secrets ([emitente]).
+
+    O resultado e memoizado (os secrets nao mudam durante o processo);
+    use _load_emitente.cache_clear() se eles forem trocados em runtime.
+    """
+    return _load_emitente()
+
+
+_NAO_DIGITO = re.compile(r"\D+")
+# documento ja limpo: CPF (11 digitos) ou CNPJ (14 digitos)
+_DOC_VALIDO = re.compile(r"\d{11}|\d{14}")
+
+
 def limpar_documento(valor: str | None) -> str:
-    return re.sub(r"\D", "", valor or "")
+    return _NAO_DIGITO.sub("", valor or "")
 
 
 def criar_emitente_pynfe():
@@ -326,22 +813,15 @@ def criar_notafiscal_pynfe(
     empresa = get_emitente_data()
     municipio_ibge = empresa.get("ibge_id", "3502804")
 
-    tipo_documento_map = {"Saída": 1, "Entrada": 0}
-    finalidade_map = {"Normal": "1", "Complementar": "2", "Ajuste": "3", "Devolução": "4"}
-    cliente_final_map = {"Sim": 1, "Não": 0}
-    presenca_map = {"Presencial": 1, "Internet": 2, "Teleatendimento": 3, "Não se aplica": 9}
-    forma_pagamento_map = {
-        "Dinheiro": 0,
-        "Cartão de Crédito": 0,
-        "Cartão de Débito": 0,
-        "PIX": 0,
-        "Boleto": 1,
-        "Transferência": 0,
-    }
-
-    total_tributos = Decimal("0.0")
-    for produto in st.session_state.get("produtos", []):
-        total_tributos += Decimal(str(produto["valor_total"])) * Decimal("0.15")
+    produtos = st.session_state.get("produtos", [])
+    if produtos:
+        # soma vetorizada em float64; so converte para Decimal no final
+        valores = np.fromiter(
+            (float(p["valor_total"]) for p in produtos), dtype=np.float64, count=len(produtos)
+        )
+        total_tributos = Decimal(f"{valores.sum() * 0.15:.2f}")
+    else:
+        total_tributos = Decimal("0.0")
 
     nfe_data_datetime = datetime.combine(nfe_data, datetime.min.time()) if nfe_data else datetime.now()
     observacoes = (
@@ -354,21 +834,21 @@ def criar_notafiscal_pynfe(
         cliente=cliente,
         uf=empresa["uf"].upper(),
         natureza_operacao=nfe_natureza or "Venda de mercadorias",
-        forma_pagamento=forma_pagamento_map.get(forma_pagamento or "Dinheiro", 0),
+        forma_pagamento=_FORMA_PAGAMENTO_MAP.get(forma_pagamento or "Dinheiro", 0),
         tipo_pagamento=1,
         modelo=55,
         serie=str(nfe_serie) if nfe_serie else "1",
         numero_nf=str(nfe_numero) if nfe_numero else "1",
         data_emissao=nfe_data_datetime,
         data_saida_entrada=nfe_data_datetime,
-        tipo_documento=tipo_documento_map.get(nfe_tipo or "Saída", 1),
+        tipo_documento=_TIPO_DOCUMENTO_MAP.get(nfe_tipo or "Saída", 1),
         municipio=municipio_ibge,
         tipo_impressao_danfe=1,
         forma_emissao="1",
-        cliente_final=cliente_final_map.get((nfe_consumidor or "Não").strip(), 0),
+        cliente_final=_CLIENTE_FINAL_MAP.get((nfe_consumidor or "Não").strip(), 0),
         indicador_destino=1,
-        indicador_presencial=presenca_map.get(nfe_presenca or "Presencial", 1),
-        finalidade_emissao=finalidade_map.get(nfe_finalidade or "Normal", "1"),
+        indicador_presencial=_PRESENCA_MAP.get(nfe_presenca or "Presencial", 1),
+        finalidade_emissao=_FINALIDADE_MAP.get(nfe_finalidade or "Normal", "1"),
         processo_emissao="0",
         transporte_modalidade_frete=9,
         informacoes_adicionais_interesse_fisco=observacoes,
@@ -376,12 +856,64 @@ def criar_notafiscal_pynfe(
     )
 
 
+def _preparar_xml(xml_bytes: bytes) -> dict[str, Any]:
+    """Parte CPU-bound do import (hash + parse), independente da Session."""
+    return {
+        "hash": db.xml_hash(xml_bytes),
+        "parsed": parse_nfe_xml(xml_bytes),
+        "xml_bytes": xml_bytes,
+    }
+
+
 def importar_xml_document(session: Session, xml_bytes: bytes, filename: str | None = None) -> dict[str, Any]:
     """
     Salva um XML de NFe na tabela nfe_xmls e importa cliente/produtos.
     """
-    xml_hash = hashlib.sha256(xml_bytes).hexdigest()
-    existing = session.scalars(select(db.NfeXml).where(db.NfeXml.hash == xml_hash)).first()
+    return _persistir_xml(session, _preparar_xml(xml_bytes), filename=filename)
+
+
+def importar_xml_documents(session: Session, arquivos: list[tuple[str, bytes]]) -> list[dict[str, Any]]:
+    """
+    Importa varios XMLs de uma vez. O hash e o parse (lxml e hashlib
+    liberam o GIL) rodam em paralelo num pool de threads; a gravacao
+    segue serial na mesma Session, cada arquivo sob um SAVEPOINT para que
+    um XML ruim nao derrube o lote inteiro.
+    """
+    resultados: list[dict[str, Any]] = []
+    if not arquivos:
+        return resultados
+
+    with ThreadPoolExecutor(max_workers=min(len(arquivos), os.cpu_count() or 1)) as pool:
+        futures = [pool.submit(_preparar_xml, dados) for _, dados in arquivos]
+        for (nome, _), future in zip(arquivos, futures):
+            try:
+                preparado = future.result()
+            except Exception as exc:
+                resultados.append({"status": "erro", "arquivo": nome, "mensagem": str(exc)})
+                continue
+            try:
+                with session.begin_nested():
+                    resultados.append(_persistir_xml(session, preparado, filename=nome))
+            except Exception as exc:
+                resultados.append({"status": "erro", "arquivo": nome, "mensagem": str(exc)})
+    return resultados
+
+
+# dedupe por hash roda uma vez por arquivo importado; statement fixo
+_NFE_BY_HASH = select(
+    db.NfeXml.id, db.NfeXml.numero, db.NfeXml.client_id
+).where(db.NfeXml.hash == bindparam("hash"))
+
+
+def _persistir_xml(session: Session, preparado: dict[str, Any], filename: str | None = None) -> dict[str, Any]:
+    """Grava um XML ja preparado por _preparar_xml (dedup, cliente, produtos)."""
+    # pop: o local precisa ser a ultima referencia para o del mais
+    # adiante liberar os bytes de fato
+    xml_bytes = preparado.pop("xml_bytes")
+    xml_hash = preparado["hash"]
+    # so as colunas pequenas: trazer a linha inteira arrastaria o
+    # xml_text gigante apenas para reportar a duplicata
+    existing = session.execute(_NFE_BY_HASH, {"hash": xml_hash}).first()
     if existing:
         nome_cliente = None
         if existing.client_id:
@@ -395,7 +927,7 @@ def importar_xml_document(session: Session, xml_bytes: bytes, filename: str | No
             "arquivo": filename,
         }
 
-    parsed = parse_nfe_xml(xml_bytes)
+    parsed = preparado["parsed"]
     chave = parsed.get("chave")
     if parsed.get("cancelada"):
         stmt = (
@@ -428,27 +960,33 @@ def importar_xml_document(session: Session, xml_bytes: bytes, filename: str | No
     store_id = cliente.documento or f"cliente_{cliente.id}"
 
     produtos_status: list[dict[str, Any]] = []
-    for produto in parsed["produtos"]:
-        resultado = db.import_row(
-            session,
-            store_id=store_id,
-            name=produto["nome"] or "Produto sem nome",
-            code=produto["codigo"] or "",
-            ncm=produto["ncm"] or None,
-            unit=produto["unidade"] or None,
-            cst_icms=produto.get("cst_icms"),
-            min_fuzzy_score=90,
-        )
-        produtos_status.append(
-            {
-                "codigo": produto.get("codigo"),
-                "nome": produto.get("nome"),
-                "status": resultado.get("status"),
-            }
-        )
+    # as leituras de import_row nao dependem de estado ORM pendente; sem
+    # autoflush cada execute do loop dispensa a checagem de dirty state
+    with session.no_autoflush:
+        for produto in parsed["produtos"]:
+            resultado = db.import_row(
+                session,
+                store_id=store_id,
+                name=produto["nome"] or "Produto sem nome",
+                code=produto["codigo"] or "",
+                ncm=produto["ncm"] or None,
+                unit=produto["unidade"] or None,
+                cst_icms=produto.get("cst_icms"),
+                min_fuzzy_score=90,
+            )
+            produtos_status.append(
+                {
+                    "codigo": produto.get("codigo"),
+                    "nome": produto.get("nome"),
+                    "status": resultado.get("status"),
+                }
+            )
 
     valor_total = _safe_decimal(parsed["valor_total"])
+    # decodifica so aqui e solta os bytes em seguida, para nao segurar as
+    # duas copias (bytes + str) do XML ate o fim da funcao
     xml_text = xml_bytes.decode("utf-8", errors="ignore")
+    del xml_bytes
     nfe_row = db.NfeXml(
         client_id=cliente.id,
         numero=parsed["numero"],
@@ -515,9 +1053,7 @@ def adicionar_produtos_pynfe(nota_fiscal):
             icms_csosn=None,
             pis_modalidade=produto["cst_pis"],
             cofins_modalidade=produto["cst_cofins"],
-            valor_tributos_aprox=str(
-                round(Decimal(str(produto["valor_total"])) * Decimal("0.15"), 2)
-            ),
+            valor_tributos_aprox=_tributo_aproximado(produto["valor_total"]),
         )
 
     return nota_fiscal
@@ -538,8 +1074,6 @@ def criar_nfe_pynfe(
     cliente_id: int | None = None,
 ):
     """Cria a NFe completa."""
-    import traceback
-
     try:
         try:
             nota_fiscal = criar_notafiscal_pynfe(
@@ -556,22 +1090,20 @@ def criar_nfe_pynfe(
                 cliente_id=cliente_id,
             )
         except Exception as e:
-            error_details = traceback.format_exc()
             return {
                 "sucesso": False,
                 "erro": f"Erro ao criar NotaFiscal: {type(e).__name__}: {str(e)}",
-                "erro_completo": f"ERRO NO PASSO 1 - CRIAR NOTAFISCAL:\n{error_details}",
+                "erro_completo": _LazyTb("ERRO NO PASSO 1 - CRIAR NOTAFISCAL:", e),
                 "nota_fiscal": None,
             }
 
         try:
             nota_fiscal = adicionar_produtos_pynfe(nota_fiscal)
         except Exception as e:
-            error_details = traceback.format_exc()
             return {
                 "sucesso": False,
                 "erro": f"Erro ao adicionar produtos: {type(e).__name__}: {str(e)}",
-                "erro_completo": f"ERRO NO PASSO 2 - ADICIONAR PRODUTOS:\n{error_details}",
+                "erro_completo": _LazyTb("ERRO NO PASSO 2 - ADICIONAR PRODUTOS:", e),
                 "nota_fiscal": None,
             }
 
@@ -579,11 +1111,10 @@ def criar_nfe_pynfe(
             serializador = SerializacaoXML(_fonte_dados, homologacao=homologacao)
             nfe_xml = serializador.exportar()
         except Exception as e:
-            error_details = traceback.format_exc()
             return {
                 "sucesso": False,
                 "erro": f"Erro na serialização XML: {type(e).__name__}: {str(e)}",
-                "erro_completo": f"ERRO NO PASSO 3 - SERIALIZAÇÃO:\nHomologação={homologacao}\n{error_details}",
+                "erro_completo": _LazyTb(f"ERRO NO PASSO 3 - SERIALIZAÇÃO:\nHomologação={homologacao}", e),
                 "nota_fiscal": None,
             }
 
@@ -600,25 +1131,23 @@ def criar_nfe_pynfe(
             }
 
         try:
-            a1 = AssinaturaA1(st.session_state.certificado_path, st.session_state.senha_certificado)
+            a1 = _assinador(st.session_state.certificado_path, st.session_state.senha_certificado)
             xml_assinado = a1.assinar(nfe_xml)
         except Exception as e:
-            error_details = traceback.format_exc()
             return {
                 "sucesso": False,
                 "erro": f"Erro na assinatura digital: {type(e).__name__}: {str(e)}",
-                "erro_completo": (
+                "erro_completo": _LazyTb(
                     "ERRO NO PASSO 5 - ASSINATURA:\n"
-                    f"Certificado: {st.session_state.certificado_path}\n{error_details}"
+                    f"Certificado: {st.session_state.certificado_path}",
+                    e,
                 ),
                 "nota_fiscal": None,
             }
-        ##CODEIA NÃO ALTERAR essas linhas
-        ##Visualização do XML apagar depois dos teste
-        xml_n_ass = etree.tostring(xml_assinado, encoding="unicode")
-        with open(f"{nota_fiscal.numero_nf} - Nota.xml", "w", encoding="utf-8") as file:
-            file.write(xml_n_ass)
-        ##fim da visualização
+        if _DUMP_XML:
+            # bytes direto do tostring, sem round-trip str -> utf-8 na escrita
+            with open(f"{nota_fiscal.numero_nf} - Nota.xml", "wb") as file:
+                file.write(etree.tostring(xml_assinado, encoding="utf-8", xml_declaration=True))
 
         if not st.session_state.comunicacao:
             return {
@@ -634,8 +1163,10 @@ def criar_nfe_pynfe(
             resposta_soap = ""
             if resultado and len(resultado) > 1:
                 resposta = resultado[1]
-                if hasattr(resposta, "text"):
-                    resposta_soap = resposta.text
+                if hasattr(resposta, "content"):
+                    # SEFAZ responde UTF-8 por especificacao; decodificar
+                    # os bytes direto evita a deteccao de charset do .text
+                    resposta_soap = resposta.content.decode("utf-8", errors="replace")
                 elif isinstance(resposta, etree._Element):
                     resposta_soap = etree.tostring(resposta, encoding="unicode")
 
@@ -688,33 +1219,28 @@ def criar_nfe_pynfe(
                 payload["erro"] = mensagem
             return payload
         except Exception as e:
-            error_details = traceback.format_exc()
             return {
                 "sucesso": False,
                 "erro": f"Erro no envio para SEFAZ: {type(e).__name__}: {str(e)}",
-                "erro_completo": (
+                "erro_completo": _LazyTb(
                     "ERRO NO PASSO 7 - ENVIO SEFAZ:\n"
-                    f"Tipo comunicação: {type(st.session_state.comunicacao)}\n{error_details}"
+                    f"Tipo comunicação: {type(st.session_state.comunicacao)}",
+                    e,
                 ),
                 "nota_fiscal": None,
             }
 
     except Exception as e:
-        import traceback as tb
-
-        error_details = tb.format_exc()
         return {
             "sucesso": False,
             "erro": f"Erro geral não tratado: {type(e).__name__}: {str(e)}",
-            "erro_completo": f"ERRO GERAL NÃO TRATADO:\n{error_details}",
+            "erro_completo": _LazyTb("ERRO GERAL NÃO TRATADO:", e),
             "nota_fiscal": None,
         }
 
 
 def cancelar_nfe(chave_cancelamento, protocolo_cancelamento, justificativa, homologacao):
     """Cancela uma NFe usando a estrutura PyNFe."""
-    import traceback
-
     try:
         if not chave_cancelamento or len(chave_cancelamento) != 44:
             return {"sucesso": False, "erro": "Chave de acesso deve ter exatamente 44 dígitos", "cStat": None, "xMotivo": None}
@@ -745,11 +1271,10 @@ def cancelar_nfe(chave_cancelamento, protocolo_cancelamento, justificativa, homo
             )
 
         except Exception as e:
-            error_details = traceback.format_exc()
             return {
                 "sucesso": False,
                 "erro": f"Erro ao criar evento de cancelamento: {type(e).__name__}: {str(e)}",
-                "erro_completo": f"ERRO NO PASSO 1 - CRIAR EVENTO:\n{error_details}",
+                "erro_completo": _LazyTb("ERRO NO PASSO 1 - CRIAR EVENTO:", e),
                 "cStat": None,
                 "xMotivo": None,
             }
@@ -759,25 +1284,23 @@ def cancelar_nfe(chave_cancelamento, protocolo_cancelamento, justificativa, homo
             nfe_cancel = serializador.serializar_evento(cancelar)
 
         except Exception as e:
-            error_details = traceback.format_exc()
             return {
                 "sucesso": False,
                 "erro": f"Erro na serialização do evento: {type(e).__name__}: {str(e)}",
-                "erro_completo": f"ERRO NO PASSO 2 - SERIALIZAÇÃO:\n{error_details}",
+                "erro_completo": _LazyTb("ERRO NO PASSO 2 - SERIALIZAÇÃO:", e),
                 "cStat": None,
                 "xMotivo": None,
             }
 
         try:
-            a1 = AssinaturaA1(st.session_state.certificado_path, st.session_state.senha_certificado)
+            a1 = _assinador(st.session_state.certificado_path, st.session_state.senha_certificado)
             xml_assinado = a1.assinar(nfe_cancel)
 
         except Exception as e:
-            error_details = traceback.format_exc()
             return {
                 "sucesso": False,
                 "erro": f"Erro na assinatura digital: {type(e).__name__}: {str(e)}",
-                "erro_completo": f"ERRO NO PASSO 3 - ASSINATURA:\n{error_details}",
+                "erro_completo": _LazyTb("ERRO NO PASSO 3 - ASSINATURA:", e),
                 "cStat": None,
                 "xMotivo": None,
             }
@@ -785,12 +1308,9 @@ def cancelar_nfe(chave_cancelamento, protocolo_cancelamento, justificativa, homo
         try:
             envio = st.session_state.comunicacao.evento(modelo="nfe", evento=xml_assinado)
 
-            if hasattr(envio, "text"):
-                response_text = envio.text
-                import re as _re
-
-                codigos = _re.findall(r"<cStat>(\d+)</cStat>", response_text)
-                motivos = _re.findall(r"<xMotivo>(.*?)</xMotivo>", response_text)
+            if hasattr(envio, "content"):
+                response_text = envio.content.decode("utf-8", errors="replace")
+                codigos, motivos = _extrair_cstat_xmotivo(response_text)
 
                 if codigos and motivos:
                     cStat = codigos[-1]
@@ -816,23 +1336,19 @@ def cancelar_nfe(chave_cancelamento, protocolo_cancelamento, justificativa, homo
                 return {"sucesso": False, "erro": "Resposta inválida da SEFAZ", "cStat": None, "xMotivo": None}
 
         except Exception as e:
-            error_details = traceback.format_exc()
             return {
                 "sucesso": False,
                 "erro": f"Erro no envio para SEFAZ: {type(e).__name__}: {str(e)}",
-                "erro_completo": f"ERRO NO PASSO 4 - ENVIO SEFAZ:\n{error_details}",
+                "erro_completo": _LazyTb("ERRO NO PASSO 4 - ENVIO SEFAZ:", e),
                 "cStat": None,
                 "xMotivo": None,
             }
 
     except Exception as e:
-        import traceback as tb
-
-        error_details = tb.format_exc()
         return {
             "sucesso": False,
             "erro": f"Erro geral não tratado: {type(e).__name__}: {str(e)}",
-            "erro_completo": f"ERRO GERAL NÃO TRATADO:\n{error_details}",
+            "erro_completo": _LazyTb("ERRO GERAL NÃO TRATADO:", e),
             "cStat": None,
             "xMotivo": None,
         }